@@ -1,23 +1,26 @@
+import hashlib
+import json
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
 import numpy as np
 import pytorch_lightning as pl
-from numba import jit
+from numba import njit
 from torch.utils.data import DataLoader, Dataset
 
 import src.misc.utils as utils
 
+# bump when the layout of the cached samples changes, older caches are then ignored
+VOXEL_CACHE_VERSION = 2
+
 
 class PolarNetDataModule(pl.LightningDataModule):
-    def __init__(self, config_name: str = "debug.yaml"):
+    def __init__(self, config_name: Union[str, dict] = "debug.yaml"):
         super().__init__()
 
-        # load configuration file
-        if Path("config/" + config_name).exists():
-            self.config = utils.load_yaml("config/" + config_name)
-        else:
-            raise FileNotFoundError("Config file can not be found.")
+        # load configuration file, or copy the config dict parsed by the caller
+        self.config = utils.load_config(config_name)
 
         # define data folder
         if Path(self.config["data_dir"]).exists():
@@ -25,9 +28,19 @@ class PolarNetDataModule(pl.LightningDataModule):
         else:
             raise FileNotFoundError("Data folder can not be found.")
 
+        # training batch size as an attribute, so the batch size tuner can scale it
+        self.train_batch = self.config["train_batch"]
+
         # define path to semantic-kitti.yaml [source: semantic-kitti-api]
         self.semkitti_config = self.config["semkitti_config"]
 
+        # dense voxel labels are only materialized per batch, in the collate function
+        self.collate_fn = partial(
+            utils.collate_fn,
+            grid_size=self.config["grid_size"],
+            unlabeled_idx=utils.ignore_class(self.semkitti_config),
+        )
+
         # failsafe for training logic
         assert self.config["projection_type"] in ["polar", "cartesian", "spherical"], "incorrect projection type"
 
@@ -55,31 +68,47 @@ class PolarNetDataModule(pl.LightningDataModule):
         if stage == "test" or stage is None:
             self.voxelised_test = voxelised_dataset(self.config, self.semkitti_test, data_split="test")
 
+    def _loader_kwargs(self) -> dict:
+        """
+        shared DataLoader settings: pinned host memory for async H2D copies and
+        persistent, prefetching workers (only valid with num_workers > 0)
+        """
+        kwargs = {"pin_memory": self.config.get("pin_memory", True)}
+        if self.config["num_workers"] > 0:
+            kwargs.update(
+                persistent_workers=self.config.get("persistent_workers", True),
+                prefetch_factor=self.config.get("prefetch_factor", 4),
+            )
+        return kwargs
+
     def train_dataloader(self):
         return DataLoader(
             self.voxelised_train,
-            collate_fn=utils.collate_fn,
+            collate_fn=self.collate_fn,
             shuffle=True,
-            batch_size=self.config["train_batch"],
+            batch_size=self.train_batch,
             num_workers=self.config["num_workers"],
+            **self._loader_kwargs(),
         )
 
     def val_dataloader(self):
         return DataLoader(
             self.voxelised_valid,
-            collate_fn=utils.collate_fn,
+            collate_fn=self.collate_fn,
             shuffle=False,
             batch_size=self.config["valid_batch"],
             num_workers=self.config["num_workers"],
+            **self._loader_kwargs(),
         )
 
     def test_dataloader(self):
         return DataLoader(
             self.voxelised_test,
-            collate_fn=utils.collate_fn,
+            collate_fn=self.collate_fn,
             shuffle=False,
             batch_size=self.config["test_batch"],
             num_workers=self.config["num_workers"],
+            **self._loader_kwargs(),
         )
 
 
@@ -91,6 +120,7 @@ class SemanticKITTI(Dataset):
     def __init__(self, data_dir: str, data_split, semkitti_config) -> None:
         self.data_dir = data_dir
         self.semkitti_yaml = utils.load_yaml(semkitti_config)
+        self.remap_lut = utils.remap_lut(self.semkitti_yaml)
         self.data_split = data_split
         self.scan_list = []
         self.label_list = []
@@ -100,34 +130,28 @@ class SemanticKITTI(Dataset):
         except ValueError:
             print("Incorrect set type")
 
-        for sequence_folder in split:
-            self.scan_list += utils.getPath(
-                "/".join([self.data_dir, "sequences", str(sequence_folder).zfill(2), "velodyne"])
-            )
-            self.label_list += utils.getPath(
-                "/".join([self.data_dir, "sequences", str(sequence_folder).zfill(2), "labels"])
-            )
-
-        self.scan_list.sort()
-        self.label_list.sort()
+        # sequences in ascending order, each folder listing is sorted already
+        for sequence_folder in sorted(split):
+            sequence_dir = "/".join([self.data_dir, "sequences", str(sequence_folder).zfill(2)])
+            self.scan_list += utils.list_files(sequence_dir + "/velodyne", ".bin")
+            self.label_list += utils.list_files(sequence_dir + "/labels", ".label")
 
     def __len__(self):
         return len(self.scan_list)
 
     def __getitem__(self, index):
 
-        # scan is containing the (x,y,z, reflection)
-        scan = np.fromfile(self.scan_list[index], dtype=np.float32).reshape(-1, 4)
+        # scan is containing the (x,y,z, reflection), memory-mapped so that the page cache is shared between workers
+        # copy-on-write mode ("c") keeps in-place augmentations local to this sample
+        scan = np.asarray(np.memmap(self.scan_list[index], dtype=np.float32, mode="c").reshape(-1, 4))
 
         # labels prepared based on semkitti documentation
         if self.data_split == "test":
             labels = np.zeros(shape=scan[:, 0].shape, dtype=int)
         else:
-            labels = np.fromfile(self.label_list[index], dtype=np.int32).reshape(-1, 1)
+            labels = np.asarray(np.memmap(self.label_list[index], dtype=np.int32, mode="r").reshape(-1, 1))
             labels = labels & 0xFFFF  # cut upper half of the binary [source: semantic-kitti-api]
-            labels = utils.remap_labels(labels, self.semkitti_yaml).reshape(
-                -1, 1
-            )  # remap to cross-entropy labels [source: semantic-kitti-api]
+            labels = self.remap_lut[labels]  # remap to cross-entropy labels [source: semantic-kitti-api]
 
         return (scan, labels)
 
@@ -146,8 +170,8 @@ class voxelised_dataset(Dataset):
     The residual distances (offset points) has been vaguely mentioned in the paper,
     therefore we have used the author's implementation from https://github.com/edwardzhou130/PolarSeg.
 
-    After unsuccessful re-implementation, due to computational inefficiency, the voxel-label voting
-    has been copied from https://github.com/edwardzhou130/PolarSeg
+    The voxel-label voting follows https://github.com/edwardzhou130/PolarSeg, but it is computed
+    with a vectorised histogram instead of a sorted scan.
     """
 
     def __init__(
@@ -158,11 +182,39 @@ class voxelised_dataset(Dataset):
     ):
         self.config = config
         self.dataset = dataset
-        self.unlabeled_idx = utils.ignore_class(config["semkitti_config"])
         self.grid_size = np.asarray(config["grid_size"])
         self.max_vol = np.asarray(config["max_vol"], dtype=np.float32)
         self.min_vol = np.asarray(config["min_vol"], dtype=np.float32)
         self.data_split = data_split
+        # point features can be transferred to the device as float16 (opt-in), halving the copied bytes,
+        # at the cost of quantising the absolute coordinates and projections (e.g. ~0.03 m at 50 m)
+        self.feature_dtype = np.float16 if config.get("fp16_features", False) else np.float32
+        if self.config["augmentations"]["fixed_vol"]:
+            assert (self.min_vol < self.max_vol).all(), "lower and upper volume boundary mismatching"
+            # voxel size of the fixed volume space (float64, the grid index divides by it as before)
+            self.voxel_size = (self.max_vol - self.min_vol) / (self.grid_size - 1)
+        # polar and cartesian voxelisation of a fixed volume run through the compiled voxelize kernel,
+        # compiled (not executed) here, so the forked workers do not each compile it
+        self.fused = self.config["augmentations"]["fixed_vol"] and config["projection_type"] in ["polar", "cartesian"]
+        if self.fused:
+            for signature in VOXELIZE_SIGNATURES:
+                voxelize.compile(signature)
+        # without flip/rot and with a fixed volume the samples are deterministic, they can be cached to disk (opt-in)
+        # under a folder of cache_dir keyed by the dataset, the voxelisation parameters and the cache format
+        self.cacheable = (
+            config.get("voxel_cache", False)
+            and config["augmentations"]["fixed_vol"]
+            and not (config["augmentations"]["flip"] or config["augmentations"]["rot"])
+        )
+        if self.cacheable:
+            cache_params = [VOXEL_CACHE_VERSION, str(Path(config["data_dir"]).resolve())]
+            cache_params += [
+                config[key] for key in ["semkitti_config", "projection_type", "grid_size", "max_vol", "min_vol"]
+            ]
+            cache_params += [config["augmentations"]["9features"], np.dtype(self.feature_dtype).name, len(dataset)]
+            cache_hash = hashlib.md5(json.dumps(cache_params).encode()).hexdigest()[:10]
+            self.cache_dir = Path(config.get("cache_dir", "data/interim/voxel_cache"), cache_hash)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
         if self.config["projection_type"] == "spherical":
             self.proj_fov_up = 3.0
             self.proj_fov_down = -25.0
@@ -175,6 +227,16 @@ class voxelised_dataset(Dataset):
 
     def __getitem__(self, index):
 
+        # load deterministic samples from the voxel cache, if already computed
+        if self.cacheable:
+            cache_file = self.cache_dir / "{}_{}.npz".format(self.data_split, index)
+            if cache_file.exists():
+                with np.load(cache_file) as cached:
+                    voxelised_data = tuple(
+                        cached[key] for key in ["voxel_label", "grid_index", "labels", "pt_features"]
+                    )
+                return voxelised_data + (index,) if self.data_split == "test" else voxelised_data
+
         # extract data
         data, labels = self.dataset[index]
         coordinate = data[:, :3]
@@ -188,86 +250,118 @@ class voxelised_dataset(Dataset):
         if self.config["augmentations"]["rot"]:
             coordinate = utils.random_rot(coordinate)
 
-        # change projection to polar
-        if self.config["projection_type"] == "polar":
-            coordinate_xy = coordinate[:, :2].copy()  # copy 2 cartesian coordinates for the 9features
-            coordinate = utils.convert2polar(coordinate)
-
-        # limit voxels to certain volume space
-        if self.config["augmentations"]["fixed_vol"]:
-            rebased_coordinate = utils.rebase(coordinate, self.min_vol, self.max_vol)
-        else:
-            rebased_coordinate = coordinate - self.min_vol
-
-            self.max_vol = np.amax(coordinate, axis=0)
-            self.min_vol = np.amin(coordinate, axis=0)
-
-        if self.config["projection_type"] == "spherical":
-            point_num = len(coordinate)
-
-            # CITATION: calculating fov, depth, yaw and pitch from https://github.com/PRBonn/lidar-bonnetal/blob/master/train/common/laserscan.py
-            fov_up = self.proj_fov_up / 180.0 * np.pi
-            fov_down = self.proj_fov_down / 180.0 * np.pi
-            fov = abs(fov_down) + abs(fov_up)
-
-            depth = np.linalg.norm(coordinate, 2, axis=1)
-            max_depth = np.floor(np.max(depth))
-            min_depth = np.floor(np.min(depth))
-            x, y, z = coordinate[:, 0], coordinate[:, 1], coordinate[:, 2]
-
-            yaw = -np.arctan2(y, x)
-            pitch = np.arcsin(z / depth)
-
-            proj_w = (0.5 * (yaw / np.pi + 1.0)) * self.proj_W
-            proj_h = (1.0 - (pitch + abs(fov_down)) / fov) * self.proj_H
-            depth = depth.reshape(point_num, 1)
-
-            proj_x_ind = np.floor(proj_h)
-            proj_x_ind = np.minimum(self.proj_H - 1, proj_x_ind)
-            proj_x_ind = np.maximum(0, proj_x_ind).astype(np.int32).reshape(point_num, 1)
-
-            proj_y_ind = np.floor(proj_w)
-            proj_y_ind = np.minimum(self.proj_W - 1, proj_y_ind)
-            proj_y_ind = np.maximum(0, proj_y_ind).astype(np.int32).reshape(point_num, 1)
-
-            grid_xy_ind = np.concatenate(([proj_x_ind, proj_y_ind]), axis=1)
-            grid_z_ind = np.zeros(shape=(point_num, 1))
-            for i in range(1, self.proj_D):
-                grid_z_ind[depth > ((max_depth - min_depth) / self.proj_D) * i] = i + 1
-            grid_index = np.concatenate(([grid_xy_ind, grid_z_ind]), axis=1).astype(np.int)
+        centered_coordinate = None
+
+        if self.fused:
+            # [polar conversion,] volume limitation, grid index and residual distances in a single pass
+            polar_projection = self.config["projection_type"] == "polar"
+            if polar_projection:
+                coordinate_xy = coordinate[:, :2].copy()  # copy 2 cartesian coordinates for the 9features
+            coordinate, grid_index, centered_coordinate = voxelize(
+                coordinate.astype(np.float32, copy=False),
+                polar_projection,
+                self.min_vol,
+                self.max_vol,
+                self.voxel_size,
+            )
 
         else:
-            # calculate the size of each voxel
-            voxel_size = (self.max_vol - self.min_vol) / (self.grid_size - 1)
-
-            # calculate the grid index for each point
-            grid_index = np.floor(rebased_coordinate / voxel_size).astype(int)
-
-        # CITATION: voxel-label voting from https://github.com/edwardzhou130/PolarSeg
-        voxel_label = np.full(self.grid_size, self.unlabeled_idx, dtype=np.uint8)
-        raw_point_label = np.concatenate([grid_index, labels.reshape(-1, 1)], axis=1)
-        sorted_point_label = raw_point_label[
-            np.lexsort((grid_index[:, 0], grid_index[:, 1], grid_index[:, 2])), :
-        ].astype(np.int64)
-        voxel_label = label_voting(np.copy(voxel_label), sorted_point_label)
-        # END OF CITATION: voxel-label voting
-
+            # change projection to polar
+            if self.config["projection_type"] == "polar":
+                coordinate_xy = coordinate[:, :2].copy()  # copy 2 cartesian coordinates for the 9features
+                coordinate = utils.convert2polar(coordinate)
+
+            # limit voxels to certain volume space
+            if self.config["augmentations"]["fixed_vol"]:
+                rebased_coordinate = utils.rebase(coordinate, self.min_vol, self.max_vol)
+            else:
+                rebased_coordinate = coordinate - self.min_vol
+
+                self.max_vol = np.amax(coordinate, axis=0)
+                self.min_vol = np.amin(coordinate, axis=0)
+
+            if self.config["projection_type"] == "spherical":
+                point_num = len(coordinate)
+
+                # CITATION: calculating fov, depth, yaw and pitch from https://github.com/PRBonn/lidar-bonnetal/blob/master/train/common/laserscan.py
+                fov_up = self.proj_fov_up / 180.0 * np.pi
+                fov_down = self.proj_fov_down / 180.0 * np.pi
+                fov = abs(fov_down) + abs(fov_up)
+
+                depth = np.linalg.norm(coordinate, 2, axis=1)
+                max_depth = np.floor(np.max(depth))
+                min_depth = np.floor(np.min(depth))
+                x, y, z = coordinate[:, 0], coordinate[:, 1], coordinate[:, 2]
+
+                yaw = -np.arctan2(y, x)
+                pitch = np.arcsin(z / depth)
+
+                proj_w = (0.5 * (yaw / np.pi + 1.0)) * self.proj_W
+                proj_h = (1.0 - (pitch + abs(fov_down)) / fov) * self.proj_H
+                depth = depth.reshape(point_num, 1)
+
+                proj_x_ind = np.floor(proj_h)
+                proj_x_ind = np.minimum(self.proj_H - 1, proj_x_ind)
+                proj_x_ind = np.maximum(0, proj_x_ind).astype(np.int32).reshape(point_num, 1)
+
+                proj_y_ind = np.floor(proj_w)
+                proj_y_ind = np.minimum(self.proj_W - 1, proj_y_ind)
+                proj_y_ind = np.maximum(0, proj_y_ind).astype(np.int32).reshape(point_num, 1)
+
+                grid_xy_ind = np.concatenate(([proj_x_ind, proj_y_ind]), axis=1)
+                # depth layer in a single pass: 0 up to the first threshold, i + 1 beyond the i-th threshold
+                depth_thresholds = ((max_depth - min_depth) / self.proj_D) * np.arange(1, self.proj_D)
+                grid_z_ind = np.digitize(depth, depth_thresholds, right=True)
+                grid_z_ind[grid_z_ind > 0] += 1
+                grid_index = np.concatenate(([grid_xy_ind, grid_z_ind]), axis=1).astype(int)
+
+            else:
+                # fixed volumes are voxelised by the voxelize kernel, here the volume is spanned by each sample
+                # calculate the size of each voxel
+                voxel_size = (self.max_vol - self.min_vol) / (self.grid_size - 1)
+
+                # calculate the grid index for each point
+                grid_index = np.floor(rebased_coordinate / voxel_size).astype(int)
+
+        # voxel-label voting, the majority label of the points in a voxel
+        voxel_label = label_voting(self.grid_size, grid_index, labels)
+
+        # fill the point features column-wise into a single array
+        point_num = len(coordinate)
         if self.config["projection_type"] == "spherical":
-            proj_xy = np.concatenate((proj_h.reshape(point_num, 1), proj_w.reshape(point_num, 1)), axis=1)
-            proj_xyz = np.concatenate((proj_xy, depth), axis=1)
-            pt_features = np.concatenate((proj_xyz, coordinate, reflection.reshape(-1, 1)), axis=1)
+            pt_features = np.empty((point_num, 7), dtype=self.feature_dtype)
+            pt_features[:, 0] = proj_h
+            pt_features[:, 1] = proj_w
+            pt_features[:, 2:3] = depth
+            pt_features[:, 3:6] = coordinate
+            pt_features[:, 6] = reflection
+        elif self.config["projection_type"] == "polar" and not self.config["augmentations"]["9features"]:
+            pt_features = np.empty((point_num, 3), dtype=self.feature_dtype)
+            pt_features[:, 0:2] = coordinate[:, :2]
+            pt_features[:, 2] = reflection
         else:
-            # CITATION: residual distances from https://github.com/edwardzhou130/PolarSeg
-            voxel_center = (grid_index.astype(float) + 0.5) * voxel_size + self.min_vol
-            centered_coordinate = coordinate - voxel_center
-            # END OF CITATION: residual distances
-            pt_features = np.concatenate((centered_coordinate, coordinate, reflection.reshape(-1, 1)), axis=1)
-
+            feature_num = 9 if self.config["projection_type"] == "polar" else 7
+            pt_features = np.empty((point_num, feature_num), dtype=self.feature_dtype)
+            if centered_coordinate is None:
+                # CITATION: residual distances from https://github.com/edwardzhou130/PolarSeg
+                voxel_center = (grid_index.astype(float) + 0.5) * voxel_size + self.min_vol
+                centered_coordinate = coordinate - voxel_center
+                # END OF CITATION: residual distances
+            pt_features[:, 0:3] = centered_coordinate
+            pt_features[:, 3:6] = coordinate
+            pt_features[:, 6] = reflection
             if self.config["projection_type"] == "polar":
-                if self.config["augmentations"]["9features"]:
-                    pt_features = np.concatenate((pt_features, coordinate_xy), axis=1)
-                else:
-                    pt_features = np.concatenate((coordinate[:, :2], reflection.reshape(-1, 1)), axis=1)
+                pt_features[:, 7:9] = coordinate_xy
+
+        if self.cacheable:
+            # grid indices are below the grid size, int16 keeps the cached scans small
+            utils.save_npz(
+                cache_file,
+                voxel_label=voxel_label,
+                grid_index=grid_index.astype(np.int16),
+                labels=labels,
+                pt_features=pt_features,
+            )
 
         if self.data_split == "test":
             voxelised_data = (voxel_label, grid_index, labels, pt_features, index)
@@ -277,7 +371,7 @@ class voxelised_dataset(Dataset):
         """
         *complete data_tuple*
         ---
-        voxel_label: voxel-level label
+        voxel_label: voxel-level label of the occupied voxels, as (flat voxel index, label) rows
         grid_index: individual point's grid index
         labels: individual point's label
         pt_features: [varies based on projection]
@@ -287,21 +381,59 @@ class voxelised_dataset(Dataset):
         return voxelised_data
 
 
-@jit("u1[:,:,:](u1[:,:,:],i8[:,:])", nopython=True, cache=True, parallel=False)
-def label_voting(voxel_label: np.array, sorted_list: list):
-    # CITATION: voxel-label voting from https://github.com/edwardzhou130/PolarSeg
-    label_counter = np.zeros((256,), dtype=np.uint)
-    label_counter[sorted_list[0, 3]] = 1
-    compare_label_a = sorted_list[0, :3]
-    for i in range(1, sorted_list.shape[0]):
-        compare_label_b = sorted_list[i, :3]
-        if not np.all(compare_label_a == compare_label_b):
-            voxel_label[compare_label_a[0], compare_label_a[1], compare_label_a[2]] = np.argmax(label_counter)
-            compare_label_a = compare_label_b
-            label_counter = np.zeros((256,), dtype=np.uint)
-        label_counter[sorted_list[i, 3]] += 1
-    voxel_label[compare_label_a[0], compare_label_a[1], compare_label_a[2]] = np.argmax(label_counter)
-    return voxel_label
+def label_voting(grid_size, grid_index: np.array, labels: np.array):
+    """
+    assign the most frequent point label to every occupied voxel (ties resolve to the lower label),
+    based on the voting from https://github.com/edwardzhou130/PolarSeg, vectorised with a per-voxel histogram
+
+    voxels are identified by their flat (C-order) index, so a single 1D sort replaces sorting three columns,
+    only the occupied voxels are returned as (flat voxel index, label) rows, the remaining ones are unlabelled
+    """
+    flat_index = (grid_index[:, 0].astype(np.int64) * grid_size[1] + grid_index[:, 1]) * grid_size[2] + grid_index[:, 2]
+    voxels, inverse = np.unique(flat_index, return_inverse=True)
+    # one histogram bin per label that occurs (up to the largest one), not per possible uint8 value
+    label_num = int(labels.max()) + 1 if len(labels) else 1
+    label_counter = np.bincount(inverse.ravel() * label_num + labels.ravel(), minlength=len(voxels) * label_num)
+    return np.stack((voxels, label_counter.reshape(-1, label_num).argmax(axis=1)), axis=1)
+
+
+# signatures of the voxelize kernel, compiled ahead of the DataLoader workers,
+# for sliced (non-contiguous) and augmented (contiguous) point clouds
+VOXELIZE_SIGNATURES = [
+    "(float32[:, :], boolean, float32[::1], float32[::1], float64[::1])",
+    "(float32[:, ::1], boolean, float32[::1], float32[::1], float64[::1])",
+]
+
+
+# serial kernel: it runs inside every DataLoader worker, which already parallelise over samples,
+# a numba thread pool per worker would oversubscribe the cpu (num_workers x cpu_count threads)
+@njit(cache=True)
+def voxelize(xyz, polar_projection, min_vol, max_vol, voxel_size):
+    """
+    fused equivalent of [convert2polar ->] rebase -> grid index -> residual distances for a fixed volume,
+    streaming the point cloud once instead of one NumPy pass per step
+
+    the rebased float32 coordinates are divided by the float64 voxel size exactly as in the NumPy path,
+    without fastmath, which could replace the division with a reciprocal multiplication and move boundary points
+    """
+    point_num = xyz.shape[0]
+    coordinate = np.empty((point_num, 3), dtype=np.float32)
+    grid_index = np.empty((point_num, 3), dtype=np.int64)
+    centered_coordinate = np.empty((point_num, 3), dtype=np.float32)
+    for i in range(point_num):
+        x, y = xyz[i, 0], xyz[i, 1]
+        if polar_projection:
+            coordinate[i, 0] = np.sqrt(x * x + y * y)
+            coordinate[i, 1] = np.arctan2(y, x)
+        else:
+            coordinate[i, 0] = x
+            coordinate[i, 1] = y
+        coordinate[i, 2] = xyz[i, 2]
+        for j in range(3):
+            rebased = min(max(coordinate[i, j], min_vol[j]), max_vol[j]) - min_vol[j]
+            grid_index[i, j] = int(np.floor(rebased / voxel_size[j]))
+            centered_coordinate[i, j] = coordinate[i, j] - ((grid_index[i, j] + 0.5) * voxel_size[j] + min_vol[j])
+    return coordinate, grid_index, centered_coordinate
 
 
 def main():
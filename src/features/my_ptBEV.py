@@ -21,6 +21,7 @@ class ptBEVnet(nn.Module):
         max_pt_per_encode=256,
         circular_padding=False,
         nine_feature=True,
+        pointnet_bf16=False,
     ):
         super(ptBEVnet, self).__init__()
 
@@ -31,6 +32,8 @@ class ptBEVnet(nn.Module):
         self.n_class = len(n_class)
         self.circular_padding = circular_padding
         self.sampling = sampling
+        # the pointwise MLP is compute-bound, run it in bfloat16 on GPUs with native support
+        self.pointnet_bf16 = pointnet_bf16 and torch.cuda.is_available() and torch.cuda.is_bf16_supported()
 
         assert self.sampling in ["random", "None"], "sampling name is incorrect"
 
@@ -73,17 +76,14 @@ class ptBEVnet(nn.Module):
 
     def forward(self, pt_fea, xy_ind, device):
         batch_size = len(pt_fea)
-        backbone_input_dim = [batch_size] + self.grid_size
-        backbone_data = torch.zeros(backbone_input_dim, dtype=torch.float32).to(device)
-        fea, ind = [], []
-        num = 0
-        for i in range(batch_size):
-            pt_num = len(pt_fea[i])
-            batch_ind = torch.cat([torch.full((pt_num, 1), i).to(device), xy_ind[i]], dim=1)
-            fea.append(pt_fea[i])
-            ind.append(batch_ind)
-            num += pt_num
-        fea, ind = torch.cat(fea, dim=0).to(device), torch.cat(ind, dim=0).to(device)
+
+        # concatenate the batch once and prepend the batch id of every point
+        pt_num = torch.tensor([len(i) for i in pt_fea], device=device)
+        batch_ind = torch.repeat_interleave(torch.arange(batch_size, device=device), pt_num)
+        fea = torch.cat(pt_fea, dim=0).to(device, non_blocking=True).float()  # features may arrive as float16
+        xy = torch.cat(xy_ind, dim=0).to(device, non_blocking=True)
+        ind = torch.cat([batch_ind.unsqueeze(1), xy.type_as(batch_ind)], dim=1)
+        num = len(fea)
 
         random_ind = torch.randperm(num, device=device)
         fea, ind = torch.index_select(fea, dim=0, index=random_ind), torch.index_select(ind, dim=0, index=random_ind)
@@ -98,7 +98,11 @@ class ptBEVnet(nn.Module):
 
         if self.sampling:
             # CITATION: random sampling from https://github.com/edwardzhou130/PolarSeg
-            grp_ind = grp_range_torch(unq_cnt, device)[torch.argsort(torch.argsort(unq_inv))]
+            # rank of every point in the stable sort of unq_inv (inverse permutation), one sort instead of two
+            order = torch.sort(unq_inv, stable=True)[1]
+            ranks = torch.empty_like(order)
+            ranks[order] = torch.arange(order.numel(), device=device)
+            grp_ind = grp_range_torch(unq_cnt, device)[ranks]
             remain_ind = grp_ind < self.max_pt
             fea = fea[remain_ind, :]
             ind = ind[remain_ind, :]
@@ -106,7 +110,9 @@ class ptBEVnet(nn.Module):
             unq_cnt = torch.clamp(unq_cnt, max=self.max_pt)
             # END OF CITATION: random sampling
 
-        pointnet_fea = self.PointNet(fea)
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=self.pointnet_bf16 and fea.is_cuda):
+            pointnet_fea = self.PointNet(fea)
+        pointnet_fea = pointnet_fea.float()
 
         max_pointnet_fea = torch_scatter.scatter_max(pointnet_fea, unq_inv, dim=0)[0]
         # max_pointnet_fea = []
@@ -116,7 +122,14 @@ class ptBEVnet(nn.Module):
         
         # CITATION: point-to-voxel from https://github.com/edwardzhou130/PolarSeg
         backbone_input_fea = self.make_backbone_input_fea_dim(max_pointnet_fea)
-        backbone_data[unq[:, 0], unq[:, 1], unq[:, 2], :] = backbone_input_fea
+        # place the voxel features into the flattened (B*H*W, n_height) BEV grid with a single index_copy_,
+        # the grid follows the feature dtype (e.g. under autocast)
+        height, width = self.grid_size[0], self.grid_size[1]
+        voxel_ind = (unq[:, 0] * height + unq[:, 1]) * width + unq[:, 2]
+        backbone_data = backbone_input_fea.new_zeros((batch_size * height * width, self.n_height))
+        backbone_data.index_copy_(0, voxel_ind, backbone_input_fea)
+        backbone_data = backbone_data.view(batch_size, height, width, self.n_height)
+        # the permuted view is already channels_last (NHWC strides), no extra copy is needed
         backbone_fea = self.backbone(backbone_data.permute(0, 3, 1, 2))
 
         return backbone_fea
@@ -1,11 +1,15 @@
+import copy
 import json
 import os
 import random
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
+from typing import Any, Optional
 
 import numpy as np
+import torch
 import yaml
-from sklearn.metrics import confusion_matrix
 
 np.seterr(invalid="ignore")  # resolve true divide warning
 
@@ -29,13 +33,27 @@ def write_dict(file: dict, out_path: str):
         out_file.close()
 
 
-def getPath(dir):
+def save_npz(out_path, **arrays):
     """
-    get full path for files in passed folder
+    dump arrays into an uncompressed .npz file, written to a temporary file first
+    so that concurrent readers (e.g. other dataloader workers) never see a partial file
     """
-    for root, _, files in os.walk(dir):
-        for f in files:
-            yield str(Path(os.path.join(root, f)))
+    tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+    with open(tmp_path, "wb") as out_file:
+        np.savez(out_file, **arrays)
+    os.replace(tmp_path, out_path)
+
+
+@lru_cache(maxsize=None)
+def list_files(dir: str, extension: str) -> tuple:
+    """
+    sorted full paths of the files with the given extension in passed folder,
+    a single os.scandir pass that is cached per folder for repeated dataset initializations
+    """
+    if not os.path.isdir(dir):
+        return ()
+    with os.scandir(dir) as entries:
+        return tuple(sorted(entry.path for entry in entries if entry.name.endswith(extension)))
 
 
 def load_unique_classes(semkitti_yaml):
@@ -65,15 +83,14 @@ def ignore_class(semkitti_yaml):
             return key
 
 
-def remap_labels(labels, semkitti_dict):
+def remap_lut(semkitti_dict):
     """
     based on [https://github.com/PRBonn/semantic-kitti-api]
-    remap labels to cross-entropy form
+    look-up table to remap (lower 16 bit) labels to cross-entropy form
     """
-    new_labels = np.zeros(len(labels), dtype=np.int8)
-    for idx, lab in enumerate(labels.squeeze()):
-        new_labels[idx] = semkitti_dict["learning_map"][lab]
-    return new_labels
+    lut = np.zeros(0x10000, dtype=np.int8)
+    lut[list(semkitti_dict["learning_map"].keys())] = list(semkitti_dict["learning_map"].values())
+    return lut
 
 
 def load_yaml(file):
@@ -82,6 +99,26 @@ def load_yaml(file):
     return dict
 
 
+def write_yaml(file: dict, out_path: str):
+    """
+    dump dictionary into .yaml file, keeping the key order
+    """
+    with open(out_path, "w") as out_file:
+        yaml.safe_dump(file, out_file, sort_keys=False)
+
+
+def load_config(config):
+    """
+    load the experiment config from a file name under config/, or copy an already parsed config dict
+    (each module gets its own copy, as the LightningModule changes it during setup)
+    """
+    if isinstance(config, dict):
+        return copy.deepcopy(config)
+    if Path("config/" + config).exists():
+        return load_yaml("config/" + config)
+    raise FileNotFoundError("Config file can not be found.")
+
+
 def move_labels(label, n):
     """
     moving unassigned labels from 0 -> 255 for unknown reason
@@ -134,15 +171,6 @@ def convert2polar(xyz):
     return np.stack((r, theta, z), axis=1)
 
 
-def conf_mat_generator(prediction, label, classes, ignore_class):
-    """
-    generate keras [classes, classes] dimensional confusion matrix,
-    based on the results with valid labels (ignore = 255)
-    """
-    ignore_idx = label != ignore_class
-    return confusion_matrix(label[ignore_idx], prediction[ignore_idx], labels=classes)
-
-
 def class_iou(cm):
     """
     Calculate intersection over union from confusion matrix, where diagonal holds the true positives (TP).
@@ -160,18 +188,68 @@ def inference_dir(inference_path=str):
     os.makedirs(inference_path, exist_ok=True)
 
 
-def collate_fn(batch):
-    label, grid_index, pt_label, pt_feature, index = [], [], [], [], []
-    for i in batch:
-        label.append(i[0].astype(np.uint8))
-        grid_index.append(i[1])
-        pt_label.append(i[2].astype(np.uint8))
-        pt_feature.append(i[3])
+def pin(data):
+    """
+    page-lock tensors (or lists of tensors), other data is passed through unchanged
+    """
+    if isinstance(data, list):
+        return [pin(i) for i in data]
+    return data.pin_memory() if torch.is_tensor(data) else data
+
+
+def to_device(data, device, non_blocking=False):
+    """
+    move tensors (or lists of tensors) to the device, other data is passed through unchanged
+    """
+    if isinstance(data, list):
+        return [to_device(i, device, non_blocking) for i in data]
+    return data.to(device, non_blocking=non_blocking) if torch.is_tensor(data) else data
+
+
+@dataclass
+class Batch:
+    """
+    Collated batch, the DataLoader calls pin_memory() on custom batch types when pin_memory=True.
+    """
+
+    vox_label: Any
+    grid_index: list
+    pt_label: list
+    pt_features: list
+    index: Optional[list] = None
+
+    def pin_memory(self):
+        self.vox_label = pin(self.vox_label)
+        self.grid_index = pin(self.grid_index)
+        self.pt_label = pin(self.pt_label)
+        self.pt_features = pin(self.pt_features)
+        return self
+
+    def to(self, device, non_blocking=False):
+        self.vox_label = to_device(self.vox_label, device, non_blocking)
+        self.grid_index = to_device(self.grid_index, device, non_blocking)
+        self.pt_label = to_device(self.pt_label, device, non_blocking)
+        self.pt_features = to_device(self.pt_features, device, non_blocking)
+        return self
+
+
+def collate_fn(batch, grid_size, unlabeled_idx=0):
+    """
+    convert voxelised samples to typed CPU tensors inside the DataLoader workers,
+    labels are remapped from 0->255 and kept as uint8 until they reach the device
+
+    the dense (B, H, W, D) voxel labels are allocated once per batch and filled
+    from the (flat voxel index, label) rows of the occupied voxels
+    """
+    vox_label = np.full((len(batch), np.prod(grid_size)), move_labels(np.uint8(unlabeled_idx), -1), dtype=np.uint8)
+    grid_index, pt_label, pt_feature, index = [], [], [], []
+    for b, i in enumerate(batch):
+        vox_label[b, i[0][:, 0]] = move_labels(i[0][:, 1].astype(np.uint8), -1)
+        grid_index.append(torch.from_numpy(i[1]).type(torch.LongTensor))
+        pt_label.append(torch.from_numpy(move_labels(i[2].astype(np.uint8), -1)))
+        pt_feature.append(torch.from_numpy(i[3]))
         if len(i) == 5:
             index.append(i[4])
 
-    if index:
-        collated = (np.stack(label), grid_index, pt_label, pt_feature, index)
-    else:
-        collated = (np.stack(label), grid_index, pt_label, pt_feature)
-    return collated
+    vox_label = torch.from_numpy(vox_label.reshape(len(batch), *grid_size))
+    return Batch(vox_label, grid_index, pt_label, pt_feature, index if index else None)
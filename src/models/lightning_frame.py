@@ -1,7 +1,8 @@
+import inspect
 import os
 import warnings
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
 import numpy as np
 import pytorch_lightning as pl
@@ -10,7 +11,6 @@ import torch.nn.functional as F
 from torchlars import LARS
 
 import src.misc.utils as utils
-import wandb
 from src.features.lovasz_losses import lovasz_softmax
 from src.features.my_ptBEV import ptBEVnet
 
@@ -18,20 +18,16 @@ warnings.filterwarnings("ignore")
 
 
 class PolarNetModule(pl.LightningModule):
-    def __init__(self, config_name: str, out_sequence: Optional[Any] = None) -> None:
+    def __init__(self, config_name: Union[str, dict], out_sequence: Optional[Any] = None) -> None:
         super().__init__()
 
-        # check if config path exists
-        if Path("config/" + config_name).exists():
-            self.config = utils.load_yaml("config/" + config_name)
-        else:
-            raise FileNotFoundError("Config file can not be found.")
+        # load configuration file, or copy the config dict parsed by the caller
+        self.config = utils.load_config(config_name)
 
         # load label information from semantic-kitti.yaml
         self.unique_class_idx, self.unique_class_name = utils.load_unique_classes(self.config["semkitti_config"])
 
         # define variables based on config file
-        self.loss_function = torch.nn.CrossEntropyLoss(ignore_index=255)
         self.out_sequence = out_sequence
         self.model_name = Path(self.config["model_save_path"]).stem
         self.inference_path = "models/inference/{}/".format(self.model_name)
@@ -46,7 +42,7 @@ class PolarNetModule(pl.LightningModule):
 
         # save configuration files to wandb
         if self.config["logging"]:
-            wandb.config.update(self.config)
+            self.logger.log_hyperparams(self.config)
 
         # initialize model and pas configurations
         self.model = ptBEVnet(
@@ -56,7 +52,8 @@ class PolarNetModule(pl.LightningModule):
             n_class=self.unique_class_idx,
             circular_padding=self.config["augmentations"]["circular_padding"],
             sampling=self.config["sampling"],
-            nine_feature = self.config["augmentations"]["9features"]
+            nine_feature=self.config["augmentations"]["9features"],
+            pointnet_bf16=self.config.get("pointnet_bf16", True),
         )
 
         # for inference, load state_dict from the <model_name>.pt instance
@@ -66,12 +63,40 @@ class PolarNetModule(pl.LightningModule):
             else:
                 raise FileExistsError("No trained model found.")
 
+        # channels_last conv weights match the NHWC layout of the BEV grid (permuted from (B, H, W, C) in the model)
+        if self.config.get("channels_last", True):
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        # compile the backbone in place (torch>=2.2), keeps the state_dict keys and runs the lightning hooks eagerly
+        if self.config.get("compile", False):
+            if hasattr(torch.nn.Module, "compile"):
+                self.model.backbone.compile(mode=self.config.get("compile_mode", "max-autotune"), fullgraph=False)
+            else:
+                print("torch.compile requires torch>=2.2, running the backbone eagerly.")
+
         # initialize evaluation metrics
         self.best_miou = 0
         self.epoch = 0
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        """
+        Copy the pinned batch to the device asynchronously, overlapping with the previous step.
+        """
+        if isinstance(batch, utils.Batch):
+            return batch.to(device, non_blocking=True)
+        return super().transfer_batch_to_device(batch, device, dataloader_idx)
+
     def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.parameters(), lr=self.config["lr_rate"])
+        # fused adam updates all parameters of a group in a single kernel (torch>=1.13, cuda only)
+        adam_kwargs = {}
+        if torch.cuda.is_available() and "fused" in inspect.signature(torch.optim.Adam).parameters:
+            adam_kwargs["fused"] = True
+        # with fsdp the flattened (sharded) parameters of the root unit belong to the wrapped trainer.model
+        if self.config.get("devices", 1) > 1 and self.config.get("strategy", "ddp") == "fsdp":
+            parameters = self.trainer.model.parameters()
+        else:
+            parameters = self.parameters()
+        optimizer = torch.optim.Adam(parameters, lr=self.config["lr_rate"], **adam_kwargs)
         if self.config["LARS"]:
             optimizer = LARS(optimizer=optimizer, eps=1e-8, trust_coef=0.001)
         return optimizer
@@ -83,17 +108,11 @@ class PolarNetModule(pl.LightningModule):
             start = torch.cuda.Event(enable_timing=True)
             end = torch.cuda.Event(enable_timing=True)
 
-        # extract batch of numpy arrays
-        vox_label, grid_index, pt_label, pt_features = batch
-
-        # remap labels from 0->255 [based on documentation from semantic-kitti-api]
-        vox_label = utils.move_labels(vox_label, -1)
-        pt_label = utils.move_labels(pt_label, -1)
-
-        # convert arrays to tensors
-        grid_index_tensor = [torch.from_numpy(i[:, :2]).type(torch.IntTensor).to(self.device) for i in grid_index]
-        pt_features_tensor = [torch.from_numpy(i).type(torch.FloatTensor).to(self.device) for i in pt_features]
-        vox_label_tensor = torch.from_numpy(vox_label).type(torch.LongTensor).to(self.device)
+        # collated tensors already on the device, labels are remapped from 0->255 in the collate_fn
+        grid_index, pt_label = batch.grid_index, batch.pt_label
+        grid_index_tensor = [i[:, :2] for i in grid_index]
+        pt_features_tensor = batch.pt_features
+        vox_label_tensor = batch.vox_label.long()
 
         if self.profiling:
             start.record()
@@ -107,28 +126,38 @@ class PolarNetModule(pl.LightningModule):
             self.inference_time.append(start.elapsed_time(end))
 
         # CITATION: loss function [https://github.com/bermanmaxim/LovaszSoftmax]
-        cross_entropy_loss = self.loss_function(prediction.detach(), vox_label_tensor)
-        lovasz_loss = lovasz_softmax(F.softmax(prediction).detach(), vox_label_tensor, ignore=255)
+        # a single log-softmax pass feeds both the cross-entropy (nll) and the lovasz loss (exp)
+        log_probas = F.log_softmax(prediction.detach(), dim=1)
+        cross_entropy_loss = F.nll_loss(log_probas, vox_label_tensor, ignore_index=255)
+        lovasz_loss = lovasz_softmax(log_probas.exp(), vox_label_tensor, ignore=255)
         combined_loss = lovasz_loss + cross_entropy_loss
         # END OF CITATION: loss function
 
         # log validation loss
         if self.config["logging"]:
-            wandb.log({"val_loss": combined_loss})
-        self.val_loss_list.append(combined_loss.detach().cpu().numpy())
+            self.logger.experiment.log({"val_loss": combined_loss})
+        self.val_loss_list.append(combined_loss.detach())
 
         prediction = torch.argmax(prediction, dim=1)
-        prediction = prediction.detach().cpu().numpy()
 
-        # generate confusion matrix from pointwise preditions and labels
-        for i, __ in enumerate(grid_index):
-            cm = utils.conf_mat_generator(
-                prediction=prediction[i, grid_index[i][:, 0], grid_index[i][:, 1], grid_index[i][:, 2]].flatten(),
-                label=pt_label[i].flatten(),
-                classes=self.unique_class_idx,
-                ignore_class=255,
-            )
-            self.confusion_matrix_sum = np.add(self.confusion_matrix_sum, cm)
+        pt_prediction = self.gather_point_prediction(prediction, grid_index)
+        pt_label = torch.cat(pt_label).flatten().long()
+
+        # accumulate confusion matrix [label, prediction] from the points with valid labels (ignore = 255)
+        n_class = len(self.unique_class_idx)
+        valid = pt_label != 255
+        cm_index = pt_label[valid] * n_class + pt_prediction[valid]
+        self.confusion_matrix_sum.view(-1).scatter_add_(0, cm_index, torch.ones_like(cm_index))
+
+    def gather_point_prediction(self, prediction, grid_index):
+        """
+        Gather the point-wise predictions of the whole batch on the device,
+        indexing the voxel predictions with the batch id and grid index of every point.
+        """
+        pt_num = torch.tensor([len(i) for i in grid_index], device=self.device)
+        pt_batch = torch.repeat_interleave(torch.arange(len(grid_index), device=self.device), pt_num)
+        gi = torch.cat(grid_index)
+        return prediction[pt_batch, gi[:, 0], gi[:, 1], gi[:, 2]]
 
     # executes at the beggining of every evaluation
     def on_validation_start(self):
@@ -139,7 +168,9 @@ class PolarNetModule(pl.LightningModule):
         """
         self.val_loss_list = []
         self.hist_list = []
-        self.confusion_matrix_sum = np.zeros((len(self.unique_class_idx), len(self.unique_class_idx)), dtype=np.int32)
+        self.confusion_matrix_sum = torch.zeros(
+            (len(self.unique_class_idx), len(self.unique_class_idx)), dtype=torch.long, device=self.device
+        )
         if self.profiling:
             self.val_results_dict = {"model_params": sum(param.numel() for param in self.model.parameters())}
             self.inference_time = []
@@ -153,10 +184,12 @@ class PolarNetModule(pl.LightningModule):
 
         Clean up inference time and write out results.
         """
-        iou = utils.class_iou(self.confusion_matrix_sum)
+        # sum the confusion matrices of all ranks (no-op on a single device)
+        confusion_matrix = self.trainer.strategy.reduce(self.confusion_matrix_sum, reduce_op="sum")
+        iou = utils.class_iou(confusion_matrix.cpu().numpy())
         for class_name, class_iou in zip(self.unique_class_name, iou):
             if self.config["logging"]:
-                wandb.log({f"{class_name}": class_iou})
+                self.logger.experiment.log({f"{class_name}": class_iou})
             if self.profiling:
                 self.val_results_dict.update({class_name: (class_iou)})
             print("%s : %.2f%%" % (class_name, class_iou))
@@ -165,12 +198,17 @@ class PolarNetModule(pl.LightningModule):
         # save model if performance is improved
         if self.best_miou < miou:
             self.best_miou = miou
-            torch.save(self.model.state_dict(), self.config["model_save_path"])
+            # every rank takes part in gathering the full state_dict through the strategy (collective with fsdp),
+            # only rank zero writes the ptBEVnet weights, without the "model." prefix of the lightning module
+            module_state = self.trainer.strategy.lightning_module_state_dict()
+            if self.trainer.is_global_zero:
+                model_state = {k.split(".", 1)[1]: v for k, v in module_state.items() if k.startswith("model.")}
+                torch.save(model_state, self.config["model_save_path"])
         print("---\nCurrent validation miou: {:.4f}\nBest validation miou: {:.4f}".format(miou, self.best_miou))
 
         # log validation results to wandb
         if self.config["logging"]:
-            wandb.log({"miou": miou, "best_miou": self.best_miou})
+            self.logger.experiment.log({"miou": miou, "best_miou": self.best_miou})
 
         # write inference results to file
         if self.profiling:
@@ -189,30 +227,26 @@ class PolarNetModule(pl.LightningModule):
 
         self.epoch += 1
         if self.config["logging"]:
-            wandb.log({"epoch": self.epoch})
+            self.logger.experiment.log({"epoch": self.epoch})
 
     def training_step(self, batch, batch_idx):
 
-        vox_label, grid_index, pt_label, pt_features = batch
-
-        # remap labels from 0->255
-        vox_label = utils.move_labels(vox_label, -1)
-        pt_label = utils.move_labels(pt_label, -1)
-
-        grid_index_tensor = [torch.from_numpy(i[:, :2]).type(torch.IntTensor).to(self.device) for i in grid_index]
-        pt_features_tensor = [torch.from_numpy(i).type(torch.FloatTensor).to(self.device) for i in pt_features]
-        vox_label_tensor = torch.from_numpy(vox_label).type(torch.LongTensor).to(self.device)
+        # labels are remapped from 0->255 in the collate_fn
+        grid_index_tensor = [i[:, :2] for i in batch.grid_index]
+        pt_features_tensor = batch.pt_features
+        vox_label_tensor = batch.vox_label.long()
 
         prediction = self.model(pt_features_tensor, grid_index_tensor, self.device)
 
         # CITATION: loss function [https://github.com/bermanmaxim/LovaszSoftmax]
-        cross_entropy_loss = self.loss_function(prediction, vox_label_tensor)
-        lovasz_loss = lovasz_softmax(F.softmax(prediction), vox_label_tensor, ignore=255)
+        log_probas = F.log_softmax(prediction, dim=1)
+        cross_entropy_loss = F.nll_loss(log_probas, vox_label_tensor, ignore_index=255)
+        lovasz_loss = lovasz_softmax(log_probas.exp(), vox_label_tensor, ignore=255)
         combined_loss = lovasz_loss + cross_entropy_loss
         # END OF CITATION: loss function
 
         if self.config["logging"]:
-            wandb.log({"train_loss": combined_loss})
+            self.logger.experiment.log({"train_loss": combined_loss})
         self.loss_list.append(combined_loss.item())
         return combined_loss
 
@@ -221,20 +255,23 @@ class PolarNetModule(pl.LightningModule):
         Test loop, saving the predicted labels under the models/inference/<model_name>/sequences/ folder.
         """
 
-        __, grid_index, __, pt_features, index = batch
+        grid_index, pt_features, index = batch.grid_index, batch.pt_features, batch.index
 
         # identical to validation loop
-        grid_index_tensor = [torch.from_numpy(i[:, :2]).type(torch.IntTensor).to(self.device) for i in grid_index]
-        pt_features_tensor = [torch.from_numpy(i).type(torch.FloatTensor).to(self.device) for i in pt_features]
+        grid_index_tensor = [i[:, :2] for i in grid_index]
+        pt_features_tensor = pt_features
 
         # identical to validation loop
         prediction = self.model(pt_features_tensor, grid_index_tensor, self.device)
-        prediction = (torch.argmax(prediction, 1)).cpu().detach().numpy()
+        prediction = torch.argmax(prediction, 1)
+
+        # only the point-wise predictions are copied to the host, then split per scan
+        pt_prediction = self.gather_point_prediction(prediction, grid_index).cpu().numpy()
+        pt_prediction = np.split(pt_prediction, np.cumsum([len(i) for i in grid_index])[:-1])
 
         for i, __ in enumerate(grid_index):
             # process point-wise predition labels
-            pt_pred_label = prediction[i, grid_index[i][:, 0], grid_index[i][:, 1], grid_index[i][:, 2]]
-            pt_pred_label = (np.expand_dims(utils.move_labels(pt_pred_label, 1), axis=1)).astype(np.uint32)
+            pt_pred_label = (np.expand_dims(utils.move_labels(pt_prediction[i], 1), axis=1)).astype(np.uint32)
 
             # find id and sequence for the of scan
             pt_id = Path(self.out_sequence.scan_list[index[i]]).stem
@@ -1,16 +1,17 @@
 import argparse
-import os
 import subprocess
 import sys
 from pathlib import Path
 
 import pytorch_lightning as pl
 
-BASE_DIR = os.path.abspath(os.curdir)
-
-if BASE_DIR not in sys.path:
-    sys.path.append(BASE_DIR)
+# make the repository root importable when run as a script without `pip install -e .`
+if __name__ == "__main__":
+    BASE_DIR = str(Path(__file__).resolve().parents[2])
+    if BASE_DIR not in sys.path:
+        sys.path.append(BASE_DIR)
 
+import src.misc.utils as utils
 from src.data.dataloader import PolarNetDataModule
 from src.models.lightning_frame import PolarNetModule
 
@@ -22,19 +23,22 @@ def main(args):
     # initialize trainer class
     trainer = pl.Trainer(accelerator="gpu", devices=1, max_epochs=1, logger=False)
 
+    # parse the config once, both modules get their own copy
+    config = utils.load_config(args.config)
+
     # initialize data module
-    polar_datamodule = PolarNetDataModule(args.config)
+    polar_datamodule = PolarNetDataModule(config)
 
     # run the trained model instance on the validation set
     if args.validate:
-        polar_model = PolarNetModule(args.config, out_sequence=None)
+        polar_model = PolarNetModule(config, out_sequence=None)
         print("---\n Running inference on validation set:\n ---\n")
         trainer.validate(model=polar_model, datamodule=polar_datamodule)
 
     # generate labels from the test splits
     if args.test:
         polar_datamodule.setup(stage="test")
-        polar_model = PolarNetModule(args.config, out_sequence=polar_datamodule.semkitti_test)
+        polar_model = PolarNetModule(config, out_sequence=polar_datamodule.semkitti_test)
         print("---\n Running inference on test set:\n ---\n")
         trainer.test(model=polar_model, datamodule=polar_datamodule)
 
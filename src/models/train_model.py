@@ -1,47 +1,193 @@
 import argparse
+import itertools
 import os
 import sys
+import time
+from functools import partial
+from pathlib import Path
 
 import pytorch_lightning as pl
-from pytorch_lightning.loggers import WandbLogger
+import torch
+from pytorch_lightning.callbacks import ModelCheckpoint
 
-BASE_DIR = os.path.abspath(os.curdir)
-
-if BASE_DIR not in sys.path:
-    sys.path.append(BASE_DIR)
+# make the repository root importable when run as a script without `pip install -e .`
+if __name__ == "__main__":
+    BASE_DIR = str(Path(__file__).resolve().parents[2])
+    if BASE_DIR not in sys.path:
+        sys.path.append(BASE_DIR)
 
+import src.misc.utils as utils
 from src.data.dataloader import PolarNetDataModule
 from src.models.lightning_frame import PolarNetModule
 
 
+def fsdp_strategy():
+    """
+    Shard parameters, gradients and optimizer states with FSDP, wrapping every U-Net down/up block separately.
+    """
+    try:
+        from pytorch_lightning.strategies import FSDPStrategy
+    except ImportError:  # pytorch_lightning<2.0, native fsdp (the "fsdp" string selects fairscale)
+        from pytorch_lightning.strategies import DDPFullyShardedNativeStrategy as FSDPStrategy
+    from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
+
+    from src.features.layer_functions import down_CBR, up_CBR
+
+    return FSDPStrategy(
+        auto_wrap_policy=partial(transformer_auto_wrap_policy, transformer_layer_cls={down_CBR, up_CBR})
+    )
+
+
+def cpu_thread_budget(num_workers, world_size):
+    """
+    Intra-op threads per process, when the dataloader workers of every rank share the cpu cores.
+    """
+    return max(1, os.cpu_count() // (max(1, num_workers) * world_size))
+
+
+def tune(trainer, polar_model, polar_datamodule, config, config_name, n_batches=50):
+    """
+    Find the largest training batch that fits into memory, then time n_batches for each worker count.
+    The fastest settings are used for training and written to config/<config>_tuned.yaml for later runs.
+
+    Only for a single device with pytorch_lightning>=2.0: the 1.x batch size finder checkpoints the model
+    before PolarNetModule.setup builds the network, and the finder is not supported by distributed strategies.
+    """
+    assert not hasattr(trainer, "tuner"), "--tune requires pytorch_lightning>=2.0"
+    from pytorch_lightning.tuner import Tuner
+
+    # binary search over the train_batch attribute of the datamodule
+    Tuner(trainer).scale_batch_size(
+        polar_model, datamodule=polar_datamodule, mode="binsearch", batch_arg_name="train_batch"
+    )
+
+    # dataloader throughput for each worker count, worker start-up is not timed
+    polar_datamodule.setup(stage="fit")
+    throughput = {}
+    for num_workers in [2, 4, 8, 16]:
+        polar_datamodule.config["num_workers"] = num_workers
+        loader = iter(polar_datamodule.train_dataloader())
+        next(loader)
+        start = time.perf_counter()
+        n_timed = sum(1 for __ in itertools.islice(loader, n_batches))
+        throughput[num_workers] = n_timed * polar_datamodule.train_batch / (time.perf_counter() - start)
+        print("num_workers: %d, %.1f samples/s" % (num_workers, throughput[num_workers]))
+        del loader
+    polar_datamodule.config["num_workers"] = max(throughput, key=throughput.get)
+
+    # persist the tuned values next to the original config
+    train_batch, num_workers = polar_datamodule.train_batch, polar_datamodule.config["num_workers"]
+    utils.write_yaml(
+        dict(config, train_batch=train_batch, num_workers=num_workers),
+        "config/" + Path(config_name).stem + "_tuned.yaml",
+    )
+    print("---\nTuned train_batch: {}, num_workers: {}".format(train_batch, num_workers))
+
+    # the cpu thread budget depends on the number of workers
+    torch.set_num_threads(cpu_thread_budget(num_workers, 1))
+
+
 def main(args):
+    # parse the config once, both modules get their own copy
+    config = utils.load_config(args.config)
+    assert not (args.tune and config.get("devices", 1) > 1), "--tune only supports a single device"
+
+    # share the cpu cores between the dataloader workers of every rank, avoids oversubscription
+    # (set first, the inter-op pool can not be resized once torch has used it)
+    world_size = config.get("devices", 1)
+    torch.set_num_threads(cpu_thread_budget(config["num_workers"], world_size))
+    torch.set_num_interop_threads(1)
+
     # initialize datamodule
-    polar_datamodule = PolarNetDataModule(args.config)
+    polar_datamodule = PolarNetDataModule(config)
 
     # initialize pytorch lightning framework
-    polar_model = PolarNetModule(args.config, out_sequence=None)
+    polar_model = PolarNetModule(config, out_sequence=None)
+
+    # allow tf32 tensor cores for the remaining fp32 matmuls and convolutions (ampere or newer)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     # generate wandb logger
+    """
+    - log_model=True uploads the checkpoint once at the end of training instead of after every save
+    - logging_mode "offline" keeps the run local, it can be uploaded later with `wandb sync`
+    """
     if polar_model.config["logging"]:
-        logger = WandbLogger(project=polar_model.config["wandb_project"], log_model="True", entity="cs492_t13")
+        from pytorch_lightning.loggers import WandbLogger
+
+        if polar_model.config.get("logging_mode", "online") == "offline":
+            os.environ["WANDB_MODE"] = "offline"
+        logger = WandbLogger(project=polar_model.config["wandb_project"], log_model=True, entity="cs492_t13")
     else:
         logger = False
 
+    # keep only the latest checkpoint, written every n epochs to a (local scratch) checkpoint directory
+    checkpoint_dir = polar_model.config.get("checkpoint_dir", os.environ.get("SCRATCH", "models/"))
+    checkpoint_callback = ModelCheckpoint(
+        save_top_k=1, every_n_epochs=polar_model.config.get("checkpoint_every_n_epochs", 1)
+    )
+
+    # optional pytorch profiler, writes a trace of the first training steps for tensorboard / chrome
+    profiler = None
+    if polar_model.config.get("profile", False):
+        try:
+            from pytorch_lightning.profilers import PyTorchProfiler
+        except ImportError:  # pytorch_lightning<1.8
+            from pytorch_lightning.profiler import PyTorchProfiler
+
+        profiler = PyTorchProfiler(
+            schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler("./tb_logs"),
+            record_shapes=True,
+            with_stack=True,
+        )
+
     # generate trainer object
     """
-    - device defaults to 1, can be changed for multi-gpu environment
+    - device defaults to 1, can be changed for multi-gpu environment,
+      more devices train with ddp (one process per gpu) and synchronised batchnorm
     - no need to change accelarator,
       pytroch lightning automatically chooses cpu if gpu is not available
+    - precision defaults to 16 bit mixed precision (autocast + grad scaling),
+      "bf16" avoids loss scaling on Ampere or newer gpus, 32 trains in full precision
+    - strategy (devices > 1): "ddp", "deepspeed_stage_2" or "fsdp" (shard model states to fit larger batches)
+    - the grid shapes are fixed, so cudnn benchmark picks the fastest convolutions once
+    - non-deterministic (faster) cudnn algorithms, sanity validation and model summary only in debug mode
     """
+    debug = polar_model.config.get("debug", False)
+    devices = polar_model.config.get("devices", 1)
+    trainer_kwargs = {}
+    if devices > 1:
+        strategy = polar_model.config.get("strategy", "ddp")
+        assert strategy in ["ddp", "deepspeed_stage_2", "fsdp"], "incorrect strategy"
+        trainer_kwargs.update(
+            strategy=fsdp_strategy() if strategy == "fsdp" else strategy,
+            sync_batchnorm=polar_model.config.get("sync_batchnorm", True),
+        )
+
     trainer = pl.Trainer(
         val_check_interval=polar_model.config["val_check_interval"],
         accelerator="gpu",
-        devices=1,
+        devices=devices,
         logger=logger,
-        default_root_dir="models/",
+        callbacks=[checkpoint_callback],
+        profiler=profiler,
+        default_root_dir=checkpoint_dir,
         max_epochs=polar_model.config["max_epochs"],
+        precision=polar_model.config.get("precision", 16),
+        benchmark=polar_model.config.get("benchmark", True),
+        accumulate_grad_batches=polar_model.config.get("accumulate_grad_batches", 1),
+        num_sanity_val_steps=2 if debug else 0,
+        deterministic=False,
+        enable_model_summary=debug,
+        **trainer_kwargs,
     )
 
+    # optionally tune the batch size and number of workers before training (single device)
+    if args.tune:
+        tune(trainer, polar_model, polar_datamodule, config, args.config)
+
     trainer.fit(model=polar_model, datamodule=polar_datamodule)
 
 
@@ -49,6 +195,7 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default="debug.yaml")
+    parser.add_argument("--tune", action="store_true", help="tune train_batch and num_workers before training")
 
     args = parser.parse_args()
     main(args)